@@ -29,6 +29,8 @@ train_cfg = {
         # loss
         'loss_type': 'mse',
         'loss_scale': 100,
+        # compile
+        'use_compile': False,
         }
 
 test_cfg = {
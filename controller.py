@@ -2,8 +2,22 @@ import numpy as np
 import torch
 import torch.multiprocessing as mp
 from tools.utils import get_space_shape, cuda
+from contextlib import nullcontext
 from copy import deepcopy
 
+
+def _plan_autocast(device):
+    '''
+    bf16 autocast for the forward-only planning rollouts: no gradients
+    flow through plan, so only the dynamics forward runs in reduced
+    precision while adaptation keeps fp32; no-op on torch builds
+    without autocast
+    '''
+    if hasattr(torch, 'autocast'):
+        device_type = 'cuda' if 'cuda' in str(device) else 'cpu'
+        return torch.autocast(device_type, dtype=torch.bfloat16)
+    return nullcontext()
+
 class Controller:
     '''
     Basic class of custom controllers, several methods required
@@ -16,13 +30,17 @@ class Controller:
 
 
 def _compute_costs_per_thread(pid, queue, K, T, U, state_init, noise, dynamics, new_dynamics_params, task):
+    # avoid intra-op oversubscription across the num_threads processes
+    torch.set_num_threads(1)
     costs = torch.zeros(K)
-    state = torch.stack(([torch.tensor(state_init, dtype=torch.float32)] * K))
+    state = torch.from_numpy(np.asarray(state_init, dtype=np.float32)).unsqueeze(0).repeat(K, 1)
+    gpu_id = next(dynamics.parameters()).device
     for t in range(T):
-        action = torch.stack(([torch.tensor(U[t] + noise[k, t, :]) for k in range(K)]))
-        gpu_id = next(dynamics.parameters()).device
-        delta_state = dynamics(cuda(torch.cat((state, action), -1), gpu_id), new_dynamics_params).detach()
-        next_state = state + delta_state.cpu()
+        # one vectorized op over all K samples instead of K tensor constructions
+        action = torch.from_numpy(U[t] + noise[:K, t, :])
+        with _plan_autocast(gpu_id):
+            delta_state = dynamics(cuda(torch.cat((state, action), -1), gpu_id), new_dynamics_params).detach()
+        next_state = state + delta_state.float().cpu()
         cost, done = task.env.get_cost(state, action, next_state)
         state = next_state
         costs += cost
@@ -63,6 +81,11 @@ class MPPI(Controller):
         self.U = None # control sequence
         self.u_init = None
 
+        # batched planning state over vectorized task copies (see reset_batch)
+        self.num_envs = 1
+        self.U_batch = None
+        self.noise_batch = None
+
         # control hyper parameters
         self.noise_mu = None
         self.noise_sigma = None
@@ -84,17 +107,56 @@ class MPPI(Controller):
 
     def _sample_noise(self):
         action_dim = get_space_shape(self.task.action_space)
-        return np.random.normal(loc=self.noise_mu, scale=self.noise_sigma, 
+        return np.random.normal(loc=self.noise_mu, scale=self.noise_sigma,
             size=(self.K, self.T, action_dim)).astype('f')
 
+    def reset_batch(self, num_envs):
+        '''
+        set up per-env control sequences and noise for batched planning
+        over num_envs vectorized copies of the task; call after set_task
+        '''
+        action_dim = get_space_shape(self.task.action_space)
+        self.num_envs = num_envs
+        self.U_batch = np.tile(self.U, (num_envs, 1, 1))
+        self.noise_batch = np.random.normal(loc=self.noise_mu, scale=self.noise_sigma,
+            size=(num_envs, self.K, self.T, action_dim)).astype('f')
+
+    def _compute_costs_batch(self, dynamics, states, new_dynamics_params=None):
+        '''
+        batched version of _compute_costs_serial: rolls out all
+        num_envs x K candidate sequences with one model forward per
+        horizon step; new_dynamics_params may be per-env [N, out, in]
+        '''
+        N, K = self.num_envs, self.K
+        state = torch.from_numpy(np.asarray(states, dtype=np.float32)).unsqueeze(1).repeat(1, K, 1).view(N * K, -1)
+        costs = torch.zeros(N, K)
+        gpu_id = next(dynamics.parameters()).device
+        batched_params = new_dynamics_params is not None and next(iter(new_dynamics_params.values())).dim() == 3
+        for t in range(self.T):
+            action = torch.from_numpy(self.U_batch[:, None, t, :] + self.noise_batch[:, :, t, :]).view(N * K, -1)
+            x = torch.cat((state, action), -1)
+            with _plan_autocast(gpu_id):
+                if batched_params:
+                    delta_state = dynamics(cuda(x.view(N, K, -1), gpu_id), new_dynamics_params).detach().view(N * K, -1)
+                else:
+                    delta_state = dynamics(cuda(x, gpu_id), new_dynamics_params).detach()
+            next_state = state + delta_state.float().cpu()
+            cost, done = self.task.env.get_cost(state, action, next_state)
+            state = next_state
+            costs += cost.view(N, K)
+            state = done * self.task.env.get_reset_state(N * K) + (1.0 - done) * state
+        return costs.numpy()
+
     def _compute_costs_serial(self, dynamics, state_init, new_dynamics_params=None):
         costs = torch.zeros(self.K)
-        state = torch.stack(([torch.tensor(state_init, dtype=torch.float32)] * self.K))
+        state = torch.from_numpy(np.asarray(state_init, dtype=np.float32)).unsqueeze(0).repeat(self.K, 1)
+        gpu_id = next(dynamics.parameters()).device
         for t in range(self.T):
-            action = torch.stack(([torch.tensor(self.U[t] + self.noise[k, t, :]) for k in range(self.K)]))
-            gpu_id = next(dynamics.parameters()).device
-            delta_state = dynamics(cuda(torch.cat((state, action), -1), gpu_id), new_dynamics_params).detach()
-            next_state = state + delta_state.cpu()
+            # one vectorized op over all K samples instead of K tensor constructions
+            action = torch.from_numpy(self.U[t] + self.noise[:, t, :])
+            with _plan_autocast(gpu_id):
+                delta_state = dynamics(cuda(torch.cat((state, action), -1), gpu_id), new_dynamics_params).detach()
+            next_state = state + delta_state.float().cpu()
             cost, done = self.task.env.get_cost(state, action, next_state)
             state = next_state
             costs += cost
@@ -177,6 +239,24 @@ class MPPI(Controller):
         weights /= np.sum(weights)
         return weights
 
+    def plan_batch(self, dynamics, states, new_dynamics_params=None):
+        '''
+        plan for all num_envs vectorized task copies at once; returns
+        [num_envs, action_dim] actions
+        '''
+        costs = self._compute_costs_batch(dynamics, states, new_dynamics_params)
+        beta = np.min(costs, axis=1, keepdims=True)
+        weights = np.exp((-1 / self.lamda) * (costs - beta))
+        weights /= np.sum(weights, axis=1, keepdims=True)
+        self.U_batch += np.einsum('nk,nktd->ntd', weights, self.noise_batch)
+        actions = self.U_batch[:, 0].copy()
+        self.U_batch[:, :-1] = self.U_batch[:, 1:]
+        if self.u_init is not None:
+            self.U_batch[:, -1] = self.u_init
+        else:
+            self.U_batch[:, -1] = np.stack([self.task.action_space.sample() for _ in range(self.num_envs)])
+        return actions
+
     def plan(self, dynamics, state, new_dynamics_params=None, debug=False):
         if debug:
             costs = self._compute_real_costs(state)
@@ -190,6 +270,12 @@ class MPPI(Controller):
         return action
 
 class MPC(MPPI):
+    def plan_batch(self, dynamics, states, new_dynamics_params=None):
+        costs = self._compute_costs_batch(dynamics, states, new_dynamics_params)
+        best_k = np.argmin(costs, axis=1)
+        actions = self.U_batch[:, 0] + self.noise_batch[np.arange(self.num_envs), best_k, 0, :]
+        return actions
+
     def plan(self, dynamics, state, new_dynamics_params=None, debug=False):
         if debug:
             costs = self._compute_real_costs(state)
@@ -6,115 +6,193 @@ from copy import deepcopy
 from collections import deque, OrderedDict
 import os
 import os.path as osp
-import gtimer as gt
+import time
 import torch.multiprocessing as mp
 mp.set_sharing_strategy('file_system')
 mp = mp.get_context('spawn')
 
 from net import Net
-from tools.utils import set_seed, zero_grad, cuda, cuda_tensor
+from tools.utils import set_seed, zero_grad, cuda, cuda_tensor, get_space_shape
 from loss import loss_func
 
 
-def _aggregate_rollout(rollout, state, action, next_state):
+class RolloutBuffer:
     '''
-    add transition (state, action, next_state) to rollout
-    rollout shape: [[s1, s2, ..., sn], [a1, a2, ..., an], [s'1, s'2, ..., s'n]]
+    pre-allocated storage for a single rollout of (s, a, s') transitions
+    rows are written in-place at each env step to avoid re-allocating and
+    copying the whole rollout history with torch.cat every step
     '''
-    if rollout == []:
-        rollout = [torch.stack((torch.tensor(state, dtype=torch.float),)),
-            torch.stack((torch.tensor(action, dtype=torch.float),)),
-            torch.stack((torch.tensor(next_state, dtype=torch.float),))]
-    else:
-        rollout = [torch.cat((rollout[0], torch.tensor(state, dtype=torch.float).view(1, -1))),
-            torch.cat((rollout[1], torch.tensor(action, dtype=torch.float).view(1, -1))),
-            torch.cat((rollout[2], torch.tensor(next_state, dtype=torch.float).view(1, -1)))]
-    return rollout
-
-def _collect_traj_per_thread(pid, event, queue, task, controller, theta, rollout_num, rollout_len, M,
-    phi, adaptation_update_num, loss_func, debug):
+    def __init__(self, capacity, dim_s, dim_a):
+        self.capacity = capacity
+        self.s = torch.empty(capacity, dim_s)
+        self.a = torch.empty(capacity, dim_a)
+        self.sp = torch.empty(capacity, dim_s)
+        self.t = 0
+
+    @classmethod
+    def for_task(cls, capacity, task):
+        return cls(capacity, get_space_shape(task.observation_space), get_space_shape(task.action_space))
+
+    @classmethod
+    def from_storage(cls, s, a, sp):
+        '''
+        wrap externally allocated (e.g. shared-memory) row storage
+        '''
+        buf = cls.__new__(cls)
+        buf.capacity = len(s)
+        buf.s, buf.a, buf.sp = s, a, sp
+        buf.t = 0
+        return buf
+
+    def add(self, state, action, next_state):
+        # from_numpy shares memory with the ndarray, so no per-step copy
+        # or dtype inference; the row assignment below is the only copy
+        self.s[self.t] = torch.from_numpy(np.asarray(state, dtype=np.float32))
+        self.a[self.t] = torch.from_numpy(np.atleast_1d(np.asarray(action, dtype=np.float32)))
+        self.sp[self.t] = torch.from_numpy(np.asarray(next_state, dtype=np.float32))
+        self.t += 1
+
+    def data(self):
+        return [self.s[:self.t], self.a[:self.t], self.sp[:self.t]]
+
+
+class AdaptationWindow:
+    '''
+    fixed-size ring over the last M transitions, stored directly as the
+    adaptation model input [M, ds+da] and target delta [M, ds]; each env
+    step overwrites one row in-place, so reading the window needs no
+    slicing, torch.cat or delta computation (row order does not matter
+    for the summed loss)
+    '''
+    def __init__(self, M, dim_s, dim_a):
+        self.M = M
+        self.dim_s = dim_s
+        self.x = torch.empty(M, dim_s + dim_a)
+        self.y = torch.empty(M, dim_s)
+        self.t = 0
+
+    @classmethod
+    def for_task(cls, M, task):
+        return cls(M, get_space_shape(task.observation_space), get_space_shape(task.action_space))
+
+    def add(self, state, action, next_state):
+        row = self.t % self.M
+        state = np.asarray(state, dtype=np.float32)
+        self.x[row, :self.dim_s] = torch.from_numpy(state)
+        self.x[row, self.dim_s:] = torch.from_numpy(np.atleast_1d(np.asarray(action, dtype=np.float32)))
+        # single fused subtract straight into the target row
+        self.y[row] = torch.from_numpy(np.asarray(next_state, dtype=np.float32) - state)
+        self.t += 1
+
+    def clear(self):
+        self.t = 0
+
+    def window(self):
+        n = min(self.t, self.M)
+        return self.x[:n], self.y[:n]
+
+def _fwd_loss(theta, loss_func, x, delta_state, new_theta):
+    '''
+    adaptation forward + loss as a standalone function so it can be
+    wrapped by torch.compile (shapes are static across calls)
+    '''
+    pred_delta_state = theta(x, new_params=new_theta)
+    return loss_func.get_loss(pred_delta_state, delta_state)
+
+def _pool_worker(in_queue, out_queue):
+    '''
+    long-lived worker process: executes (func, args) jobs from the parent
+    until it receives the None sentinel, so process startup and module
+    import are paid once instead of on every parallel call
+    '''
+    # one intra-op thread per worker; otherwise each of the num_threads
+    # processes fans out to all cores and they thrash each other
+    os.environ['OMP_NUM_THREADS'] = '1'
+    torch.set_num_threads(1)
+    while True:
+        job = in_queue.get()
+        if job is None:
+            break
+        func, args = job
+        out_queue.put(func(*args))
+
+def _collect_traj_per_thread(pid, task, controller, theta, rollout_num, rollout_len, M,
+    phi, adaptation_update_num, loss_func, debug, shared_rollouts, offset):
     '''
     per thread function of parallel trajectory collection
     see MBMRL._collect_traj_serial() for method description
+    rollouts are written straight into the parent-allocated shared-memory
+    tensors (shared_rollouts, starting at row offset), so only the step
+    counters travel back through the queue
     '''
-    rollouts = []
     state = task.reset()
     controller.set_task(task)
     _n_model_steps_total = 0
     _n_task_steps_total = 0
 
-    for _ in range(rollout_num):
-        rollout = []
+    # walk the module tree once instead of per inner step; buffers
+    # never change during adaptation so they are shared, not cloned
+    named_params = list(theta.named_parameters())
+    base_theta_dict = dict(theta.named_buffers())
+
+    window = AdaptationWindow.for_task(M, task)
+    for r in range(rollout_num):
+        buf = RolloutBuffer.from_storage(shared_rollouts[0][offset + r],
+            shared_rollouts[1][offset + r], shared_rollouts[2][offset + r])
+        window.clear()
         t = 0
         while t < rollout_len:
             new_theta_dict = None
 
-            if not debug:
-                past_traj = [r[-M:] for r in rollout]
-                if past_traj:
-                    st, ac, next_st = past_traj
-                    st, ac, next_st = cuda(st), cuda(ac), cuda(next_st)
-                    delta_st = next_st - st
-                    st_ac = torch.cat((st, ac), 1)
+            if not debug and window.t > 0:
+                st_ac, delta_st = window.window()
+                st_ac, delta_st = cuda(st_ac), cuda(delta_st)
 
+                # adaptation here only feeds controller.plan, never a meta
+                # update, so no second-order graph is needed
+                new_theta_params = None
+                for i in range(adaptation_update_num + 1):
                     pred_delta_st = theta(st_ac, new_params=new_theta_dict)
-                    loss = loss_func.get_loss(pred_delta_st, delta_st) / len(st)
+                    loss = loss_func.get_loss(pred_delta_st, delta_st) / len(st_ac)
                     _n_model_steps_total += 1
-                    d_theta = autograd.grad(loss, theta.parameters())
-
-                    new_theta_dict = {key: val.clone() for key, val in theta.state_dict().items()}
-                    new_theta_params = OrderedDict()
-                    for (key, val), d, ph in zip(theta.named_parameters(), d_theta, phi):
-                        new_theta_params[key] = val - ph * d
+                    if i == 0:
+                        d_theta = autograd.grad(loss, [val for _, val in named_params])
+                        new_theta_dict = dict(base_theta_dict)
+                        new_theta_params = OrderedDict()
+                    else:
+                        d_theta = autograd.grad(loss, new_theta_params.values())
+                    for (key, val), d, ph in zip(named_params, d_theta, phi):
+                        new_theta_params[key] = (val - ph * d).detach().requires_grad_()
                         new_theta_dict[key] = new_theta_params[key]
-                    
-                    for _ in range(adaptation_update_num):
-                        pred_delta_st = theta(st_ac, new_params=new_theta_dict)
-                        new_loss = loss_func.get_loss(pred_delta_st, delta_st) / len(st)
-                        _n_model_steps_total += 1
-                        d_theta = autograd.grad(new_loss, new_theta_params.values(), create_graph=True)
-                        for (key, val), d, ph in zip(theta.named_parameters(), d_theta, phi):
-                            new_theta_params[key] = val - ph * d
-                            new_theta_dict[key] = new_theta_params[key]
 
             action = controller.plan(theta, state, new_theta_dict)
             next_state, _, done, _ = task.step(action)
-            if action.shape == ():
-                action = [action]
-            rollout = _aggregate_rollout(rollout, state, action, next_state)
+            buf.add(state, action, next_state)
+            window.add(state, action, next_state)
             state = next_state
             t += 1
             _n_task_steps_total += 1
             if done:
                 state = task.reset()
-        rollouts.append(rollout)
-    if queue is None:
-        return rollouts, _n_model_steps_total, _n_task_steps_total
-    else:
-        queue.put([rollouts, _n_model_steps_total, _n_task_steps_total])
-        event.wait()
-
-def _evaluate_per_thread(queue, tasks, controller, theta):
+    return _n_model_steps_total, _n_task_steps_total
+
+def _evaluate_per_thread(tasks, controller, theta, sample_num):
     '''
     per thread function of reward evaluation
     see MBMRL._evaluate_serial() for method description
+    runs sample_num rollouts per task and returns per-task reward sums
     '''
-    rewards = []
-    for task in tasks:
+    reward_sums = np.zeros(len(tasks))
+    for i, task in enumerate(tasks):
         controller.set_task(task)
-        state = task.reset()
-        done = False
-        reward_sum = 0
-        while not done:
-            action = controller.plan(theta, state)
-            state, reward, done, _ = task.step(action)
-            reward_sum += reward
-        rewards.append(reward_sum)
-    
-    if queue is None:
-        return rewards
-    else:
-        queue.put(rewards)
+        for _ in range(sample_num):
+            state = task.reset()
+            done = False
+            while not done:
+                action = controller.plan(theta, state)
+                state, reward, done, _ = task.step(action)
+                reward_sums[i] += reward
+    return reward_sums
 
 
 class MBMRL:
@@ -123,8 +201,10 @@ class MBMRL:
     Original Paper: Nagabandi et al., 2019, 'Learning to Adapt in Dynamic, Real-World Environments through Meta-Reinforcement Learning'
     '''
     def __init__(self, tasks, model, controller, logger, seed, iteration_num, task_sample_num, task_sample_frequency, eval_frequency, eval_sample_num,
-            rollout_len, rollout_num, adaptation_update_num, traj_sample_num, M, K, beta, eta, phi, dataset_size, loss_type, loss_scale, num_threads):
+            rollout_len, rollout_num, adaptation_update_num, traj_sample_num, M, K, beta, eta, phi, dataset_size, loss_type, loss_scale, num_threads,
+            use_compile=False):
         set_seed(seed)
+        torch.set_default_dtype(torch.float32)  # rollout buffers and env data are all float32
         self.logger = logger
 
         self.tasks = np.array(tasks)    # training tasks
@@ -147,19 +227,60 @@ class MBMRL:
         self.loss_func = loss_func[loss_type](loss_scale=loss_scale)  # loss between real and predicted value of next state
         self.num_threads = num_threads  # number of threads for parallization
 
+        # optionally compile the adaptation forward+loss; flag-guarded since
+        # torch.compile with create_graph=True still has edge cases
+        self.use_compile = use_compile and hasattr(torch, 'compile')
+        self._fwd_loss = torch.compile(_fwd_loss, dynamic=False) if self.use_compile else _fwd_loss
+
         self.theta = cuda(model)  # dynamics neural network model
+        # cache the parameter list and the buffer dict once; buffers never
+        # change during adaptation so they are shared, not cloned, and
+        # load_state_dict copies in-place so the cached objects stay valid
+        self._named_params = list(self.theta.named_parameters())
+        self._base_theta_dict = dict(self.theta.named_buffers())
+
+        # persistent worker pool: spawn once, feed jobs through queues
+        self._pool = None
+        self._vec_envs = {}  # per-task-id vectorized envs for batched collection
+        if self.num_threads > 1:
+            self.theta.share_memory_()
+            self._start_pool()
         self.meta_optimizer = torch.optim.Adam(self.theta.parameters(), lr=self.beta)   # optimizer for dynamics
         self.phi = cuda_tensor(([phi] * sum(p.numel() for p in self.theta.parameters())), requires_grad=True)   # update rule of adaptation (learning rate in GrBAL)
         self.lr_optimizer = torch.optim.Adam([self.phi], lr=self.eta)   # optimizer for update rule of adaptation
 
         self.theta_loss = None
         self.eval_rewards = []
+        self._iter_times = {}   # per-segment durations of the last iteration
         self._epoch_start_time = None
         self._n_task_steps_total = 0
         self._n_model_steps_total = 0
         self._n_rollouts_total = 0
         self._time_total = 0
 
+    def _start_pool(self):
+        self._in_queue = mp.Queue()
+        self._out_queue = mp.Queue()
+        self._pool = []
+        for _ in range(self.num_threads):
+            worker = mp.Process(target=_pool_worker, args=(self._in_queue, self._out_queue), daemon=True)
+            worker.start()
+            self._pool.append(worker)
+
+    def _close_pool(self):
+        if self._pool is not None:
+            for _ in self._pool:
+                self._in_queue.put(None)
+            for worker in self._pool:
+                worker.join()
+            self._pool = None
+
+    def __del__(self):
+        self._close_pool()
+        for vec_env in self._vec_envs.values():
+            vec_env.close()
+        self._vec_envs = {}
+
     ##### LOGGER #####
 
     def _get_params(self, iter):
@@ -220,11 +341,10 @@ class MBMRL:
         self.logger.save_extra_data(self._get_extra_data())
 
     def _record_stats(self):
-        times_itrs = gt.get_times().stamps.itrs
-        sample_time = times_itrs['sample'][-1]
-        adaptation_time = times_itrs['adaptation'][-1]
-        meta_time = times_itrs['meta'][-1]
-        eval_time = times_itrs['eval'][-1]
+        sample_time = self._iter_times['sample']
+        adaptation_time = self._iter_times['adaptation']
+        meta_time = self._iter_times['meta']
+        eval_time = self._iter_times['eval']
         iter_time = sample_time + adaptation_time + meta_time
         self._time_total += iter_time
 
@@ -246,43 +366,96 @@ class MBMRL:
 
      ##### ALGORITHM #####
 
-    def _compute_adaptation_loss(self, theta, traj, new_theta=None):
+    def _prepare_traj(self, traj):
+        '''
+        move trajectory to device and build the model input once,
+        so repeated adaptation updates reuse the same tensors
+        '''
         state, action, next_state = traj
         state, action, next_state = cuda(state), cuda(action), cuda(next_state)
         delta_state = next_state - state
-        pred_delta_state = theta(torch.cat((state, action), 1), new_params=new_theta)
-        loss = self.loss_func.get_loss(pred_delta_state, delta_state) / len(state)
+        x = torch.cat((state, action), 1)
+        return x, delta_state
+
+    def _compute_prepared_loss(self, theta, x, delta_state, new_theta=None):
+        loss = self._fwd_loss(theta, self.loss_func, x, delta_state, new_theta) / len(x)
         self._n_model_steps_total += 1
         return loss
 
+    def _compute_adaptation_loss(self, theta, traj, new_theta=None):
+        x, delta_state = self._prepare_traj(traj)
+        return self._compute_prepared_loss(theta, x, delta_state, new_theta)
+
     def _adaptation_update(self, theta, traj, loss_func_update=False):
         if traj == []:
             return None
-
-        loss = self._compute_adaptation_loss(theta, traj)
-        d_theta = autograd.grad(loss, theta.parameters(), retain_graph=True)
-
-        new_theta_dict = {key: val.clone() for key, val in theta.state_dict().items()}
-        new_theta_params = OrderedDict()
-        for (key, val), d, phi in zip(theta.named_parameters(), d_theta, self.phi):
-            new_theta_params[key] = val - phi * d
-            new_theta_dict[key] = new_theta_params[key]
-        
-        if loss_func_update:
-            self.loss_func.update(loss)
-        
-        for _ in range(self.adaptation_update_num):
-            new_loss = self._compute_adaptation_loss(theta, traj, new_theta_dict)
-            zero_grad(new_theta_params.values())
-            d_theta = autograd.grad(new_loss, new_theta_params.values(), create_graph=True, retain_graph=True)
-            for (key, val), d, phi in zip(theta.named_parameters(), d_theta, self.phi):
+        x, delta_state = self._prepare_traj(traj)
+        return self._adaptation_update_prepared(theta, x, delta_state, loss_func_update)
+
+    def _adaptation_update_prepared(self, theta, x, delta_state, loss_func_update=False):
+        new_theta_dict, new_theta_params = None, None
+        for i in range(self.adaptation_update_num + 1):
+            loss = self._compute_prepared_loss(theta, x, delta_state, new_theta_dict)
+            if i == 0:
+                d_theta = autograd.grad(loss, [val for _, val in self._named_params], retain_graph=True)
+                new_theta_dict = dict(self._base_theta_dict)
+                new_theta_params = OrderedDict()
+            else:
+                zero_grad(new_theta_params.values())
+                d_theta = autograd.grad(loss, new_theta_params.values(), create_graph=True, retain_graph=True)
+            for (key, val), d, phi in zip(self._named_params, d_theta, self.phi):
                 new_theta_params[key] = val - phi * d
                 new_theta_dict[key] = new_theta_params[key]
 
             if loss_func_update:
-                self.loss_func.update(new_loss)
+                self.loss_func.update(loss)
         return new_theta_dict
 
+    def _batched_adaptation_update(self, loss_func_update=False):
+        '''
+        run the adaptation updates for all task_sample_num sampled
+        trajectories at once with task-batched parameters [N, ...],
+        instead of looping over tasks with tiny per-task batches;
+        returns the meta loss averaged over tasks
+        '''
+        m_xs, m_deltas, k_xs, k_deltas = [], [], [], []
+        for _ in range(self.task_sample_num):
+            m_trajs, k_trajs = self._sample_traj()
+            x, delta = self._prepare_traj(m_trajs)
+            m_xs.append(x)
+            m_deltas.append(delta)
+            x, delta = self._prepare_traj(k_trajs)
+            k_xs.append(x)
+            k_deltas.append(delta)
+        m_x, m_delta = torch.stack(m_xs), torch.stack(m_deltas)
+        k_x, k_delta = torch.stack(k_xs), torch.stack(k_deltas)
+
+        # replicate theta over the task dim; each task's loss only touches
+        # its own slice, so one autograd.grad yields all per-task gradients
+        batched_params = OrderedDict(
+            (key, val.unsqueeze(0).repeat((self.task_sample_num,) + (1,) * val.dim()))
+            for key, val in self._named_params)
+
+        params = batched_params
+        for i in range(self.adaptation_update_num + 1):
+            loss = self._fwd_loss(self.theta, self.loss_func, m_x, m_delta, params) / m_x.shape[1]
+            self._n_model_steps_total += 1
+            if i == 0:
+                d_theta = autograd.grad(loss, list(params.values()), retain_graph=True)
+            else:
+                zero_grad(params.values())
+                d_theta = autograd.grad(loss, list(params.values()), create_graph=True, retain_graph=True)
+            params = OrderedDict(
+                (key, val - phi * d)
+                for (key, val), d, phi in zip(batched_params.items(), d_theta, self.phi))
+
+            if loss_func_update:
+                self.loss_func.update(loss / self.task_sample_num)
+
+        meta_loss = self._fwd_loss(self.theta, self.loss_func, k_x, k_delta, params) / k_x.shape[1]
+        self._n_model_steps_total += 1
+        return meta_loss / self.task_sample_num
+
     def _meta_update(self, meta_loss):
         meta_loss.backward(retain_graph=True)
 
@@ -295,95 +468,186 @@ class MBMRL:
         self.loss_func.zero_grad()
 
     def _collect_traj_parallel(self, task, debug=False):
-        workers = []
-        event = mp.Event()
-        queue = mp.Queue()
+        # workers fill parent-allocated shared-memory tensors in place, so
+        # the queue only carries the shared handles out and counters back
+        dim_s = get_space_shape(task.observation_space)
+        dim_a = get_space_shape(task.action_space)
+        shared_rollouts = [torch.empty(self.rollout_num, self.rollout_len, dim).share_memory_()
+            for dim in (dim_s, dim_a, dim_s)]
+
         rollout_nums = np.full(self.num_threads, self.rollout_num // self.num_threads, dtype=np.int)
         rollout_nums[:self.rollout_num % self.num_threads] += 1
+        job_num, offset = 0, 0
         for pid, rollout_num_per_thread in zip(range(self.num_threads), rollout_nums):
             if rollout_num_per_thread > 0:
-                worker_args = (pid, event, queue, task, self.controller, self.theta, rollout_num_per_thread, self.rollout_len, self.M,
-                    self.phi, self.adaptation_update_num, self.loss_func, debug)
-                workers.append(mp.Process(target=_collect_traj_per_thread, args=worker_args))
-        for worker in workers:
-            worker.start()
-        
-        rollouts = []
-        for _ in workers:
-            rollouts_per_thread, _n_model_steps_total, _n_task_steps_total = queue.get()
-            rollouts.extend(rollouts_per_thread)
+                worker_args = (pid, task, self.controller, self.theta, rollout_num_per_thread, self.rollout_len, self.M,
+                    self.phi, self.adaptation_update_num, self.loss_func, debug, shared_rollouts, offset)
+                self._in_queue.put((_collect_traj_per_thread, worker_args))
+                job_num += 1
+                offset += rollout_num_per_thread
+
+        for _ in range(job_num):
+            _n_model_steps_total, _n_task_steps_total = self._out_queue.get()
             self._n_model_steps_total += _n_model_steps_total
             self._n_task_steps_total += _n_task_steps_total
-        event.set()
+        rollouts = [[shared_rollouts[dim][r] for dim in range(3)] for r in range(self.rollout_num)]
         return rollouts
 
     def _collect_traj_serial(self, task, debug=False):
         rollouts = []
         self.controller.set_task(task)
         state = task.reset()
+        window = AdaptationWindow.for_task(self.M, task)
         for _ in range(self.rollout_num):
-            rollout = []
+            buf = RolloutBuffer.for_task(self.rollout_len, task)
+            window.clear()
             t = 0
             while t < self.rollout_len:
                 new_theta_dict = None
-                if not debug:
-                    past_traj = [r[-self.M:] for r in rollout]
-                    new_theta_dict = self._adaptation_update(self.theta, past_traj)
+                if not debug and window.t > 0:
+                    x, delta_state = window.window()
+                    new_theta_dict = self._adaptation_update_prepared(self.theta, cuda(x), cuda(delta_state))
                 action = self.controller.plan(self.theta, state, new_theta_dict)
                 next_state, _, done, _ = task.step(action)
-                if action.shape == ():
-                    action = [action]
-                rollout = _aggregate_rollout(rollout, state, action, next_state)
+                buf.add(state, action, next_state)
+                window.add(state, action, next_state)
                 state = next_state
                 t += 1
                 self._n_task_steps_total += 1
                 if done:
                     state = task.reset()
-            rollouts.append(rollout)
+            rollouts.append(buf.data())
         return rollouts
 
+    def _get_vec_env(self, task):
+        # vectorized envs are expensive to start, keep one per task id
+        env_id = task.spec.id
+        if env_id not in self._vec_envs:
+            self._vec_envs[env_id] = gym.vector.AsyncVectorEnv(
+                [(lambda: gym.make(env_id)) for _ in range(self.rollout_num)])
+        return self._vec_envs[env_id]
+
+    def _vector_adaptation_update(self, x, delta_state):
+        '''
+        first-order adaptation for all vectorized envs at once: x is
+        [N, n, ds+da], delta_state [N, n, ds], returns per-env adapted
+        parameters [N, ...] for the batched planning forward
+        '''
+        num_envs = x.shape[0]
+        # collection never meta-updates, so adapt detached replicas
+        batched_params = OrderedDict(
+            (key, val.detach().unsqueeze(0).repeat((num_envs,) + (1,) * val.dim()).requires_grad_())
+            for key, val in self._named_params)
+
+        params = batched_params
+        for _ in range(self.adaptation_update_num + 1):
+            loss = self._fwd_loss(self.theta, self.loss_func, x, delta_state, params) / x.shape[1]
+            self._n_model_steps_total += 1
+            d_theta = autograd.grad(loss, list(params.values()))
+            params = OrderedDict(
+                (key, (val - phi * d).detach().requires_grad_())
+                for (key, val), d, phi in zip(batched_params.items(), d_theta, self.phi))
+        return params
+
+    def _collect_traj_vectorized(self, task, debug=False):
+        '''
+        collect all rollout_num rollouts simultaneously: one vectorized env
+        steps rollout_num task copies and the controller plans for the whole
+        batch with a single model forward per step
+        '''
+        num_envs = self.rollout_num
+        dim_s = get_space_shape(task.observation_space)
+        dim_a = get_space_shape(task.action_space)
+        rollout_s, rollout_a, rollout_sp = (torch.empty(num_envs, self.rollout_len, dim)
+            for dim in (dim_s, dim_a, dim_s))
+        win_x = torch.empty(num_envs, self.M, dim_s + dim_a)
+        win_y = torch.empty(num_envs, self.M, dim_s)
+
+        vec_env = self._get_vec_env(task)
+        self.controller.set_task(task)
+        self.controller.reset_batch(num_envs)
+        states = vec_env.reset()
+
+        for t in range(self.rollout_len):
+            new_theta_dict = None
+            if not debug and t > 0:
+                n = min(t, self.M)
+                new_theta_dict = self._vector_adaptation_update(cuda(win_x[:, :n]), cuda(win_y[:, :n]))
+            actions = self.controller.plan_batch(self.theta, states, new_theta_dict)
+            next_states, _, dones, infos = vec_env.step(actions)
+
+            st = torch.from_numpy(np.asarray(states, dtype=np.float32))
+            ac = torch.from_numpy(np.asarray(actions, dtype=np.float32))
+            # the vectorized env auto-resets, so recover the true terminal
+            # observation for finished envs where the env reports it
+            sp = np.asarray(next_states, dtype=np.float32).copy()
+            for env_idx, (done, info) in enumerate(zip(dones, infos)):
+                if done and 'terminal_observation' in info:
+                    sp[env_idx] = np.asarray(info['terminal_observation'], dtype=np.float32)
+            sp = torch.from_numpy(sp)
+
+            rollout_s[:, t], rollout_a[:, t], rollout_sp[:, t] = st, ac, sp
+            row = t % self.M
+            win_x[:, row, :dim_s] = st
+            win_x[:, row, dim_s:] = ac
+            win_y[:, row] = sp - st
+            states = next_states
+            self._n_task_steps_total += num_envs
+
+        return [[rollout_s[i], rollout_a[i], rollout_sp[i]] for i in range(num_envs)]
+
     def _collect_traj(self, *args, **kwargs):
         if self.num_threads > 1:
             return self._collect_traj_parallel(*args, **kwargs)
+        elif hasattr(gym, 'vector') and self.rollout_num > 1:
+            return self._collect_traj_vectorized(*args, **kwargs)
         else:
             return self._collect_traj_serial(*args, **kwargs)
 
+    def _sample_rollout_indices(self):
+        '''
+        draw all rollout ids and start offsets for one call in two batched
+        RNG ops instead of two np.random.choice calls per trajectory;
+        offsets are uniform draws scaled to each rollout's valid range
+        '''
+        rollout_ids = torch.randint(len(self.dataset), (self.traj_sample_num,)).tolist()
+        offsets = torch.rand(self.traj_sample_num).tolist()
+        return rollout_ids, offsets
+
     def _sample_traj(self, debug=False):
+        traj_len = self.M + self.K
+        rollout_ids, offsets = self._sample_rollout_indices()
         if not debug:
-            m_trajs, k_trajs = [], []
-            for _ in range(self.traj_sample_num):
-                rollout = self.dataset[np.random.choice(len(self.dataset))]
-                m_start_idx = np.random.choice(len(rollout[0]) + 1 - self.M - self.K)
+            m_trajs, k_trajs = None, None
+            for i, (rollout_id, offset) in enumerate(zip(rollout_ids, offsets)):
+                rollout = self.dataset[rollout_id]
+                if m_trajs is None:
+                    # pre-allocate concatenated buffers instead of growing with torch.cat
+                    m_trajs = [torch.empty(self.traj_sample_num * self.M, r.shape[1]) for r in rollout]
+                    k_trajs = [torch.empty(self.traj_sample_num * self.K, r.shape[1]) for r in rollout]
+                m_start_idx = int(offset * (len(rollout[0]) + 1 - traj_len))
                 m_end_idx = m_start_idx + self.M
                 k_start_idx = m_end_idx
                 k_end_idx = k_start_idx + self.K
-                m_traj = [r[m_start_idx: m_end_idx] for r in rollout]
-                k_traj = [r[k_start_idx: k_end_idx] for r in rollout]
-                if m_trajs == []:
-                    m_trajs = m_traj
-                else:
-                    m_trajs = [torch.cat((m_trajs[dim], m_traj[dim])) for dim in range(3)]
-                if k_trajs == []:
-                    k_trajs = k_traj
-                else:
-                    k_trajs = [torch.cat((k_trajs[dim], k_traj[dim])) for dim in range(3)]
+                for dim in range(3):
+                    m_trajs[dim][i * self.M: (i + 1) * self.M].copy_(rollout[dim][m_start_idx: m_end_idx])
+                    k_trajs[dim][i * self.K: (i + 1) * self.K].copy_(rollout[dim][k_start_idx: k_end_idx])
             return m_trajs, k_trajs
         else:
-            trajs = []
-            for _ in range(self.traj_sample_num):
-                rollout = self.dataset[np.random.choice(len(self.dataset))]
-                start_idx = np.random.choice(len(rollout[0]) + 1 - self.M - self.K)
-                end_idx = start_idx + self.M + self.K
-                traj = [r[start_idx: end_idx] for r in rollout]
-                if trajs == []:
-                    trajs = traj
-                else:
-                    trajs = [torch.cat((trajs[dim], traj[dim])) for dim in range(3)]
+            trajs = None
+            for i, (rollout_id, offset) in enumerate(zip(rollout_ids, offsets)):
+                rollout = self.dataset[rollout_id]
+                if trajs is None:
+                    trajs = [torch.empty(self.traj_sample_num * traj_len, r.shape[1]) for r in rollout]
+                start_idx = int(offset * (len(rollout[0]) + 1 - traj_len))
+                end_idx = start_idx + traj_len
+                for dim in range(3):
+                    trajs[dim][i * traj_len: (i + 1) * traj_len].copy_(rollout[dim][start_idx: end_idx])
             return trajs
 
     def _sample_task(self):
         # TODO: support task distribution
-        task = np.random.choice(self.tasks)
+        task = self.tasks[torch.randint(len(self.tasks), ()).item()]
         return task
 
     def _resume_train(self, load_iter):
@@ -396,19 +660,20 @@ class MBMRL:
         return start_iter
 
     def _evaluate_parallel(self):
-        workers = []
-        queue = mp.Queue()
-        for _ in range(self.eval_sample_num):
-            worker_args = (queue, self.tasks, self.controller, self.theta)
-            workers.append(mp.Process(target=_evaluate_per_thread, args=worker_args))
-        for worker in workers:
-            worker.start()
-
-        mean_rewards = []
-        for _ in workers:
-            rewards = queue.get()
-            mean_rewards.append(rewards)
-        mean_rewards = np.mean(mean_rewards, axis=1)
+        # distribute eval_sample_num across the pool instead of one job per sample
+        sample_nums = np.full(self.num_threads, self.eval_sample_num // self.num_threads, dtype=np.int)
+        sample_nums[:self.eval_sample_num % self.num_threads] += 1
+        job_num = 0
+        for sample_num in sample_nums:
+            if sample_num > 0:
+                worker_args = (self.tasks, self.controller, self.theta, sample_num)
+                self._in_queue.put((_evaluate_per_thread, worker_args))
+                job_num += 1
+
+        reward_sums = np.zeros(len(self.tasks))
+        for _ in range(job_num):
+            reward_sums += self._out_queue.get()
+        mean_rewards = reward_sums / self.eval_sample_num
         return mean_rewards
 
     def _evaluate_serial(self):
@@ -437,46 +702,44 @@ class MBMRL:
         return mean_rewards
 
     def debug(self):
-        gt.reset()
-        gt.set_def_unique(False)
-
-        for i in gt.timed_for(range(self.iteration_num), save_itrs=True):
+        for i in range(self.iteration_num):
             self._start_iteration(i)
 
+            t_start = time.perf_counter()
             if i % self.task_sample_frequency == 0:
                 self.logger.log('Data Collection')
                 task = self._sample_task()
                 rollouts = self._collect_traj(task, debug=True)
                 self._n_rollouts_total += 1
                 self.dataset.extend(rollouts)
-            gt.stamp('sample')
+            self._iter_times['sample'] = time.perf_counter() - t_start
 
             self.logger.log('Adaptation Update')
 
+            t_start = time.perf_counter()
             for _ in range(self.adaptation_update_num):
                 trajs = self._sample_traj(debug=True)
                 self.theta_loss = self._compute_adaptation_loss(self.theta, trajs)
                 self._meta_update(self.theta_loss)
+            self._iter_times['adaptation'] = time.perf_counter() - t_start
+            self._iter_times['meta'] = 0.0
 
-            gt.stamp('adaptation')
-            gt.stamp('meta')
-
+            t_start = time.perf_counter()
             if i % self.eval_frequency == 0:
                 self.logger.log('Evaluation')
                 self.evaluate()
-            gt.stamp('eval')
+            self._iter_times['eval'] = time.perf_counter() - t_start
 
             self._end_iteration(i)
 
 
     def train(self, resume=False, load_iter=None):
-        gt.reset()
-        gt.set_def_unique(False)
         start_iter = self._resume_train(load_iter) if resume else 0
 
-        for i in gt.timed_for(range(start_iter, self.iteration_num), save_itrs=True):
+        for i in range(start_iter, self.iteration_num):
             self._start_iteration(i)
 
+            t_start = time.perf_counter()
             if i % self.task_sample_frequency == 0:
                 self.logger.log('Data Collection')
                 task = self._sample_task()
@@ -484,32 +747,25 @@ class MBMRL:
                 rollouts = self._collect_traj(task)
                 self._n_rollouts_total += 1
                 self.dataset.extend(rollouts)
-                # np.random.shuffle(self.dataset)
-            gt.stamp('sample')
+            self._iter_times['sample'] = time.perf_counter() - t_start
 
             self.logger.log('Adaptation Update')
-            new_losses = []
-            for _ in range(self.task_sample_num):
-                # sample M+K steps from dataset
-                m_trajs, k_trajs = self._sample_traj()
-                # do adaptation update, get new theta and gradients
-                new_theta_dict = self._adaptation_update(self.theta, m_trajs, loss_func_update=True)
-                # compute loss using new theta
-                new_loss = self._compute_adaptation_loss(self.theta, k_trajs, new_theta_dict)
-                new_losses.append(new_loss)
-            self.theta_loss = torch.mean(torch.stack(new_losses))
-            gt.stamp('adaptation')
+            t_start = time.perf_counter()
+            # adaptation update and meta loss for all sampled tasks in one batched pass
+            self.theta_loss = self._batched_adaptation_update(loss_func_update=True)
+            self._iter_times['adaptation'] = time.perf_counter() - t_start
 
             # do meta update on theta and phi
             self.logger.log('Meta Update')
+            t_start = time.perf_counter()
             self._meta_update(self.theta_loss)
-            gt.stamp('meta')
-
+            self._iter_times['meta'] = time.perf_counter() - t_start
 
+            t_start = time.perf_counter()
             if i % self.eval_frequency == 0:
                 self.logger.log('Evaluation')
                 self.evaluate()
-            gt.stamp('eval')
+            self._iter_times['eval'] = time.perf_counter() - t_start
 
             self._end_iteration(i)
 
@@ -517,8 +773,6 @@ class MBMRL:
         set_seed(seed)
         iteration_num = int(iteration_num)
 
-        gt.reset()
-        gt.set_def_unique(False)
         start_iter = 0
 
         params = self.logger.load_params(load_iter)
@@ -527,41 +781,48 @@ class MBMRL:
         extra_data = self.logger.load_extra_data()
         self._set_extra_data(extra_data)
 
-        rollout = []
+        window = AdaptationWindow.for_task(self.M, task)
         state = task.reset()
         self.controller.set_task(task)
-        
-        for i in gt.timed_for(range(start_iter, iteration_num), save_itrs=True):
+
+        for i in range(start_iter, iteration_num):
 
             t = 0
             done = False
             reward_sum = 0
             state = task.reset()
+            # carry the adapted parameter set across steps instead of
+            # writing every update back into theta through the optimizers
+            new_theta_dict, new_theta_params = None, None
             while not done:
-                past_traj = [r[-self.M:] for r in rollout]
-                
-                if past_traj != []:
+                if window.t > 0:
+                    x, delta_state = window.window()
+                    x, delta_state = cuda(x), cuda(delta_state)
+                    if new_theta_params is None:
+                        new_theta_params = OrderedDict(
+                            (key, val.detach().clone().requires_grad_()) for key, val in self._named_params)
+                        new_theta_dict = dict(self._base_theta_dict)
+                        new_theta_dict.update(new_theta_params)
                     for _ in range(self.adaptation_update_num):
-                        loss = self._compute_adaptation_loss(self.theta, past_traj)
-                        zero_grad(self.theta.parameters())
-                        self._meta_update(loss)
+                        loss = self._compute_prepared_loss(self.theta, x, delta_state, new_theta_dict)
+                        d_theta = autograd.grad(loss, list(new_theta_params.values()))
+                        for (key, val), d, phi in zip(list(new_theta_params.items()), d_theta, self.phi):
+                            new_theta_params[key] = (val - phi * d).detach().requires_grad_()
+                            new_theta_dict[key] = new_theta_params[key]
 
-                action = self.controller.plan(self.theta, state, None, debug)
+                action = self.controller.plan(self.theta, state, new_theta_dict, debug)
                 next_state, reward, done, _ = task.step(action)
                 reward_sum += reward
 
                 if render:
                     task.render()
 
-                if action.shape == ():
-                    action = [action]
-                
-                rollout = _aggregate_rollout(rollout, state, action, next_state)
+                window.add(state, action, next_state)
                 state = next_state
                 t += 1
-                
+
                 if done:
-                    rollout = []
+                    window.clear()
                     state = task.reset()
 
             print('Iteration:', i, 'Reward:', reward_sum, 'Traj len:', t)
@@ -2,6 +2,16 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+# canonical stateless forward on newer torch; fall back to the manual
+# per-layer substitution below on builds without it
+try:
+    from torch.func import functional_call
+except ImportError:
+    try:
+        from torch.nn.utils.stateless import functional_call
+    except ImportError:
+        functional_call = None
+
 
 class Net(nn.Module):
     def __init__(self, input_shape, output_shape, hid_shape, hid_num, activation='tanh'):
@@ -23,13 +33,25 @@ class Net(nn.Module):
         layers.append(nn.Linear(self.hid_shape, self.output_shape))
         self.model = nn.Sequential(*layers)
 
+    def _linear(self, x, new_params, i):
+        weight = new_params['model.%d.weight' % i]
+        bias = new_params['model.%d.bias' % i]
+        if weight.dim() == 3:
+            # task-batched parameters: weight [N, out, in], bias [N, out], x [N, B, in]
+            return torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+        else:
+            return F.linear(x, weight, bias)
+
     def forward(self, x, new_params=None):
         if new_params is None:
             return self.model(x)
+        elif new_params['model.0.weight'].dim() == 2 and functional_call is not None:
+            # single dispatch through the module instead of one Python hop
+            # per layer; task-batched [N, out, in] params keep the bmm path
+            return functional_call(self, new_params, (x,))
         else:
             for i in range(self.hid_num + 1):
-                x = F.linear(x, new_params['model.%d.weight' % (i * 2)], new_params['model.%d.bias' % (i * 2)])
+                x = self._linear(x, new_params, i * 2)
                 x = self.activation[1](x)
-            x = F.linear(x, new_params['model.%d.weight' % ((self.hid_num + 1) * 2)], new_params['model.%d.bias' % ((self.hid_num + 1) * 2)])
+            x = self._linear(x, new_params, (self.hid_num + 1) * 2)
             return x
-            
\ No newline at end of file